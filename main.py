@@ -1,300 +1,768 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import os
 import sys
 import json
-import argparse
+import hashlib
 import logging
 import time
-from typing import Dict, List, Optional
-import urllib.request
-import urllib.parse
-import urllib.error
+import threading
+import http.client
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlencode, urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _parse_log_level(value: str) -> int | None:
+    """Return the logging level for a name like 'debug' or a number like '10', or None."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value.upper())
+    return level if isinstance(level, int) else None
 
+
+_log_level = _parse_log_level(os.environ.get('SLACK_LOG_LEVEL', 'INFO'))
 logging.basicConfig(
-    level=logging.INFO,
+    level=logging.INFO if _log_level is None else _log_level,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+if _log_level is None:
+    logger.warning("Unknown SLACK_LOG_LEVEL %r, using INFO", os.environ['SLACK_LOG_LEVEL'])
+
+CACHE_DIR = '/tmp/slack_cache'
+SLACK_API_HOST = 'slack.com'
+COLORS = {
+    "start": "#2196F3",
+    "progress": "#FF9800",
+    "success": "#4CAF50",
+    "failure": "#F44336",
+    "skipped": "#9E9E9E"
+}
+DEFAULT_COLOR = COLORS["progress"]
+# A phase that has failed keeps its failure colour and status.
+FAILURE_COLOR = COLORS["failure"]
+# Kept low so parallel cleanup stays inside Slack's per-method rate limits.
+MAX_CONCURRENT_REQUESTS = 4
+# conversations.list filters by type after paginating, so look up one type
+# at a time, starting with the usual home of the storage channel.
+CHANNEL_LOOKUP_TYPES = ('private_channel', 'public_channel')
+# Methods that take a JSON body; everything else is sent form-encoded.
+JSON_METHODS = ('chat.postMessage', 'chat.update')
+# Retries on HTTP 429 before giving up; each waits for Slack's Retry-After.
+MAX_RATE_LIMIT_RETRIES = 2
+# Longest Retry-After, in seconds, worth waiting out inside a CI step.
+MAX_RETRY_AFTER = 30.0
+# The local state log is rewritten as one snapshot once it grows past this.
+STATE_LOG_COMPACT_SIZE = 64 * 1024
+# State messages older than this belong to finished workflows.
+STATE_MAX_AGE = 10 * 60 * 60
+# Phase text for a phase with exactly one step; must match the generic
+# rendering in _render_phase_attachments.
+FIRST_STEP_TEXT = "%s\n\n*Steps:*\n• %s"
+# How long update() waits on the storage save before warning that it is slow.
+STORAGE_SAVE_TIMEOUT = 5.0
+# Storage messages fetched when checking the local state is still current.
+STATE_CHECK_LIMIT = 20
+# Errors meaning a cached storage channel ID no longer points at a usable channel.
+STALE_CHANNEL_ERRORS = ('channel_not_found', 'not_in_channel')
+# Errors meaning a storage message can no longer be edited and must be re-posted.
+STALE_MESSAGE_ERRORS = ('message_not_found', 'cant_update_message')
+
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj) -> bytes:
+        # Match orjson's compact output; nothing reads the state files by hand.
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    _json_loads = json.loads
 
 
 class SlackAPIError(Exception):
-    pass
+
+    def __init__(self, message: str, error: str | None = None):
+        super().__init__(message)
+        # Slack's error code, e.g. 'channel_not_found', when the API returned one.
+        self.error = error
+
+
+def _with_cursor(base_body: bytes, cursor: str) -> bytes:
+    """Append a pagination cursor to an already form-encoded request body."""
+    return base_body + b'&' + urlencode({'cursor': cursor}).encode('utf-8')
+
+
+def _read_cache_file(path: str) -> bytes | None:
+    """Read a whole cache file, or return None if it does not exist.
+
+    Opening directly (unbuffered) instead of checking os.path.exists first
+    saves a stat call on every cache read.
+    """
+    try:
+        with open(path, 'rb', buffering=0) as fh:
+            return fh.readall()
+    except FileNotFoundError:
+        return None
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Write data to path via a temp file and os.replace so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+
+def _phases_by_name(phases) -> dict[str, dict]:
+    """Key phases by name, accepting the list layout written by older versions.
+
+    List entries may be out of order when runner clocks disagree, so they
+    are sorted by started_at; dicts already keep the order phases started in.
+    """
+    if isinstance(phases, dict):
+        return phases
+    return {p['name']: p for p in sorted(phases, key=lambda p: p.get('started_at', 0))}
 
 
 class SlackNotifier:
 
-    def __init__(self, token: str, channel: str, workflow_id: str, storage_channel_name: str):
+    def __init__(self, token: str, channel: str, workflow_id: str,
+                 storage_channel_name: str | None = None,
+                 storage_channel_id: str | None = None,
+                 mirror_storage: bool = True,
+                 pipeline_title: str = "Infrastructure Deployment Pipeline"):
         self.token = token
         self.channel = channel
         self.workflow_id = workflow_id
         self.storage_channel_name = storage_channel_name
-        self.storage_channel_id = None
-        self.pipeline_title = "Infrastructure Deployment Pipeline"
-
-        self.colors = {
-            "start": "#2196F3",
-            "progress": "#FF9800",
-            "success": "#4CAF50",
-            "failure": "#F44336",
-            "skipped": "#9E9E9E"
+        self.storage_channel_id = storage_channel_id
+        self.mirror_storage = mirror_storage
+        self.state_file = os.path.join(CACHE_DIR, f"pipeline_{workflow_id}.ndjson")
+        self.pending_file = os.path.join(CACHE_DIR, f"pending_{workflow_id}")
+        # Digest of the last chat.update body sent, to skip no-op edits.
+        self.payload_hash_file = os.path.join(CACHE_DIR, f"payload_hash_{workflow_id}.bin")
+        self.storage_channel_cache = os.path.join(CACHE_DIR, f"storage_channel_{storage_channel_name}.txt")
+        self._storage_channel_cached = False
+        self.pipeline_title = pipeline_title
+        self._local = threading.local()
+        # Shared by every request, like a session's default headers.
+        self._json_headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        self._form_headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/x-www-form-urlencoded'
         }
+        self._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
 
-        self._resolve_storage_channel_id()
+        if self.mirror_storage and not self.storage_channel_id:
+            self._resolve_storage_channel_id()
 
-    def _resolve_storage_channel_id(self) -> None:
+    @property
+    def pipeline_title(self) -> str:
+        return self._pipeline_title
 
-        try:
-            payload = {'types': 'public_channel,private_channel', 'limit': 200}
-            response = self._slack_request('conversations.list', payload)
+    @pipeline_title.setter
+    def pipeline_title(self, title: str) -> None:
+        self._pipeline_title = title
+        # The header only depends on the title and CIRCLE_* variables, which
+        # are fixed for the life of the process, so encode it per title.
+        self._header_bytes = _json_dumps(self._build_header_attachment())
 
-            for channel in response.get('channels', []):
-                if channel['name'] == self.storage_channel_name:
-                    self.storage_channel_id = channel['id']
-                    return
+    def _build_header_attachment(self) -> dict:
 
-            cursor = response.get('response_metadata', {}).get('next_cursor')
-            while cursor:
-                payload['cursor'] = cursor
-                response = self._slack_request('conversations.list', payload)
+        branch = os.environ.get('CIRCLE_BRANCH', 'unknown')
+        username = os.environ.get('CIRCLE_USERNAME', 'unknown')
+        build_url = os.environ.get('CIRCLE_BUILD_URL', '#')
+        repo_name = os.environ.get('CIRCLE_PROJECT_REPONAME', 'repo')
+        build_num = os.environ.get('CIRCLE_BUILD_NUM', '0')
+
+        return {
+            "color": "#2196F3",
+            "blocks": [
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": (
+                            f"🚀 *{self.pipeline_title}*\n\n"
+                            f"*Branch:* `{branch}` | *User:* `{username}`\n"
+                            f"<{build_url}|View Pipeline>"
+                        )
+                    }
+                },
+                {
+                    "type": "context",
+                    "elements": [
+                        {
+                            "type": "mrkdwn",
+                            "text": f":gear: `{repo_name}` | :hash: Build #{build_num}"
+                        }
+                    ]
+                }
+            ]
+        }
 
-                for channel in response.get('channels', []):
-                    if channel['name'] == self.storage_channel_name:
-                        self.storage_channel_id = channel['id']
-                        return
+    def _resolve_storage_channel_id(self) -> None:
+        """Resolve the storage channel name to its ID, caching the result on disk.
 
-                cursor = response.get('response_metadata', {}).get('next_cursor')
+        conversations.list is paginated and heavily rate-limited, so the
+        lookup only happens once per runner; later invocations read the
+        cached ID from CACHE_DIR.
+        """
+        cached_id = (_read_cache_file(self.storage_channel_cache) or b'').decode('utf-8').strip()
+        if cached_id:
+            self.storage_channel_id = cached_id
+            self._storage_channel_cached = True
+            logger.info("Using cached storage channel ID: %s", cached_id)
+            return
 
-            raise SlackAPIError(f"Channel '{self.storage_channel_name}' not found")
+        self._storage_channel_cached = False
+
+        try:
+            for channel_type in CHANNEL_LOOKUP_TYPES:
+                self.storage_channel_id = self._find_channel_id(channel_type)
+                if self.storage_channel_id:
+                    break
+            else:
+                raise SlackAPIError(f"Channel '{self.storage_channel_name}' not found")
 
         except Exception as e:
-            logger.error(f"Failed to resolve storage channel: {e}")
+            logger.error("Failed to resolve storage channel: %s", e)
             raise
 
-    def _slack_request(self, method: str, payload: Dict) -> Dict:
+        try:
+            _atomic_write(self.storage_channel_cache, self.storage_channel_id.encode('utf-8'))
+        except OSError as e:
+            logger.warning("Failed to cache storage channel ID: %s", e)
 
-        url = f"https://slack.com/api/{method}"
+    def _call_storage(self, fn, *args):
+        """Run a storage channel call, re-resolving a stale cached channel ID once.
 
-        if method in ['chat.postMessage', 'chat.update']:
-            data = json.dumps(payload).encode('utf-8')
-            headers = {
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/json'
-            }
+        A cached ID outlives renames and re-creations of the channel, so a
+        channel error drops the cache and retries against a fresh lookup.
+        """
+        try:
+            return fn(*args)
+        except SlackAPIError as e:
+            if e.error not in STALE_CHANNEL_ERRORS or not self._storage_channel_cached:
+                raise
+            logger.warning("Cached storage channel ID %s is stale (%s), resolving again",
+                           self.storage_channel_id, e.error)
+
+        try:
+            os.remove(self.storage_channel_cache)
+        except FileNotFoundError:
+            pass
+        self._resolve_storage_channel_id()
+        return fn(*args)
+
+    def _find_channel_id(self, channel_type: str) -> str | None:
+
+        base_body = urlencode({'types': channel_type, 'exclude_archived': 'true', 'limit': 999}).encode('utf-8')
+        body = base_body
+
+        while True:
+            response = self._slack_request('conversations.list', body)
+            match = next(
+                (c['id'] for c in response.get('channels', ()) if c['name'] == self.storage_channel_name),
+                None
+            )
+            if match:
+                return match
+
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return None
+            body = _with_cursor(base_body, cursor)
+
+    def _get_connection(self) -> http.client.HTTPSConnection:
+        """Return this thread's keep-alive connection to the Slack API, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPSConnection(SLACK_API_HOST, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def _reset_connection(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def _post(self, path: str, data: bytes, headers: dict) -> bytes:
+
+        rate_limit_retries = 0
+        while True:
+            conn = self._get_connection()
+            reused = conn.sock is not None
+            try:
+                conn.request('POST', path, body=data, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._reset_connection()
+                # Slack closes idle keep-alive connections; retry once on a fresh one.
+                if reused:
+                    continue
+                raise
+            except Exception:
+                self._reset_connection()
+                raise
+
+            if response.will_close:
+                self._reset_connection()
+
+            if response.status == 429 and rate_limit_retries < MAX_RATE_LIMIT_RETRIES:
+                rate_limit_retries += 1
+                retry_after = self._retry_after(response, rate_limit_retries)
+                if retry_after > MAX_RETRY_AFTER:
+                    raise SlackAPIError(
+                        f"Rate limited on {path} for {retry_after:.0f}s, longer than {MAX_RETRY_AFTER:.0f}s"
+                    )
+                logger.warning("Rate limited on %s, retrying in %.1fs", path, retry_after)
+                time.sleep(retry_after)
+                continue
+
+            if response.status != 200:
+                raise SlackAPIError(f"HTTP {response.status} {response.reason} from {path}")
+
+            return body
+
+    @staticmethod
+    def _retry_after(response: http.client.HTTPResponse, attempt: int) -> float:
+        """Seconds to wait after a 429, from Retry-After or exponential backoff."""
+        try:
+            return max(float(response.getheader('Retry-After')), 0.0)
+        except (TypeError, ValueError):
+            return min(float(2 ** (attempt - 1)), MAX_RETRY_AFTER)
+
+    def _slack_request(self, method: str, payload: dict | bytes) -> dict:
+        """Call a Slack Web API method.
+
+        payload is either a dict, encoded as JSON for chat.postMessage and
+        chat.update and as a form body otherwise, or a body already encoded
+        that way, which is sent unchanged.
+        """
+        path = f"/api/{method}"
+
+        if isinstance(payload, bytes):
+            data = payload
+        elif method in JSON_METHODS:
+            data = _json_dumps(payload)
         else:
-            data = urllib.parse.urlencode(payload).encode('utf-8')
-            headers = {
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
+            data = urlencode(payload).encode('utf-8')
 
-        req = urllib.request.Request(url, data=data, headers=headers)
+        headers = self._json_headers if method in JSON_METHODS else self._form_headers
 
         try:
-            with urllib.request.urlopen(req, timeout=30) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
+            response_data = _json_loads(self._post(path, data, headers))
 
             if not response_data.get('ok'):
                 error_msg = response_data.get('error', 'Unknown error')
-                raise SlackAPIError(f"Slack API error: {error_msg}")
+                raise SlackAPIError(f"Slack API error: {error_msg}", error_msg)
 
             return response_data
 
-        except urllib.error.URLError as e:
-            logger.error(f"HTTP request failed: {e}")
+        except (http.client.HTTPException, OSError) as e:
+            logger.error("HTTP request failed: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Slack API request failed: {e}")
+            logger.error("Slack API request failed: %s", e)
             raise
 
-    def _get_all_storage_messages(self) -> List[Dict]:
+    def _get_storage_messages(self, oldest: float | None = None) -> list[dict]:
+        """Page through storage history, newest first.
 
+        With oldest set, Slack only returns messages newer than it and paging
+        stops after the page holding this workflow's latest message. Without
+        it, the whole channel is listed.
+        """
         all_messages = []
         try:
-            payload = {'channel': self.storage_channel_id, 'limit': 200}
+            params = {'channel': self.storage_channel_id, 'limit': 200}
+            if oldest is not None:
+                params['oldest'] = f"{oldest:.6f}"
+            base_body = urlencode(params).encode('utf-8')
+            body = base_body
 
             while True:
-                response = self._slack_request('conversations.history', payload)
+                response = self._slack_request('conversations.history', body)
                 messages = response.get('messages', [])
                 all_messages.extend(messages)
 
+                if oldest is not None and any(self.workflow_id in msg.get('text', '') for msg in messages):
+                    break
+
                 cursor = response.get('response_metadata', {}).get('next_cursor')
                 if not cursor:
                     break
-                payload['cursor'] = cursor
+                body = _with_cursor(base_body, cursor)
 
         except Exception as e:
-            logger.error(f"Failed to get storage messages: {e}")
+            if isinstance(e, SlackAPIError) and e.error in STALE_CHANNEL_ERRORS:
+                raise
+            logger.error("Failed to get storage messages: %s", e)
 
         return all_messages
 
-    def _cleanup_and_find_pipeline(self) -> Optional[Dict]:
+    @staticmethod
+    def _parse_state_messages(candidates: list[tuple[float, dict]]) -> list[tuple[float, str, dict]]:
 
-        messages = self._get_all_storage_messages()
-        current_time = time.time()
-        ten_hours_ago = current_time - (10 * 60 * 60)
+        states = []
+        for msg_time, msg in candidates:
+            try:
+                data = _json_loads(msg['text'])
+            except (ValueError, KeyError):
+                continue
+            if isinstance(data, dict):
+                states.append((msg_time, msg['ts'], data))
+        return states
 
-        pipeline_msg = None
-        to_delete = []
+    def _find_pipeline(self) -> dict | None:
 
-        for msg in messages:
-            try:
-                if not msg.get('bot_id'):
-                    continue
+        window_start = time.time() - STATE_MAX_AGE
+        return self._latest_pipeline(self._call_storage(self._get_storage_messages, window_start))
 
-                msg_time = float(msg['ts'])
+    def _find_pipeline_since(self, storage_ts: str) -> dict | None:
+        """Find this workflow's latest state among the messages from storage_ts on.
 
-                if msg_time < ten_hours_ago:
-                    to_delete.append(msg['ts'])
-                    continue
+        Returns None when the message at storage_ts is not on the single
+        page fetched, so the page cannot be trusted to hold the latest state.
+        """
+        response = self._slack_request('conversations.history', {
+            'channel': self.storage_channel_id,
+            'oldest': storage_ts,
+            'inclusive': 'true',
+            'limit': STATE_CHECK_LIMIT
+        })
+        messages = response.get('messages', [])
+        if not any(msg.get('ts') == storage_ts for msg in messages):
+            return None
+        return self._latest_pipeline(messages)
 
-                data = json.loads(msg['text'])
-                msg_workflow_id = data.get('workflow_id')
+    def _latest_pipeline(self, messages: list[dict]) -> dict | None:
 
-                if msg_workflow_id == self.workflow_id:
-                    if not pipeline_msg or msg_time > float(pipeline_msg['ts']):
-                        if pipeline_msg:
-                            to_delete.append(pipeline_msg['ts'])
-                        pipeline_msg = {
-                            'data': data,
-                            'ts': msg['ts']
-                        }
-                    else:
-                        to_delete.append(msg['ts'])
+        candidates = [(float(msg['ts']), msg) for msg in messages if msg.get('bot_id')]
+        matches = [
+            state for state in self._parse_state_messages(candidates)
+            if state[2].get('workflow_id') == self.workflow_id
+        ]
 
-            except (json.JSONDecodeError, ValueError, KeyError):
-                continue
+        if not matches:
+            return None
+
+        latest = max(matches, key=lambda m: m[0])
+        return {'data': latest[2], 'ts': latest[1]}
+
+    def cleanup_storage(self) -> None:
+        """Delete stale and superseded state messages from the storage channel.
+
+        Kept off the update() path; run it periodically with --cleanup.
+        """
+        if not self.storage_channel_id:
+            self._resolve_storage_channel_id()
+
+        window_start = time.time() - STATE_MAX_AGE
+        messages = self._call_storage(self._get_storage_messages)
+
+        candidates = [(float(msg['ts']), msg) for msg in messages if msg.get('bot_id')]
+        to_delete = [msg['ts'] for msg_time, msg in candidates if msg_time < window_start]
 
-        for ts in to_delete:
+        fresh = [c for c in candidates if c[0] >= window_start]
+        seen_workflows = set()
+        for _, ts, data in sorted(self._parse_state_messages(fresh), key=lambda m: m[0], reverse=True):
+            workflow_id = data.get('workflow_id')
+            if workflow_id in seen_workflows:
+                to_delete.append(ts)
+            else:
+                seen_workflows.add(workflow_id)
+
+        list(self._executor.map(self._delete_storage_message, to_delete))
+        logger.info("Storage cleanup removed %d message(s)", len(to_delete))
+
+    def _delete_storage_message(self, ts: str) -> None:
+
+        try:
+            self._slack_request('chat.delete', {
+                'channel': self.storage_channel_id,
+                'ts': ts
+            })
+            logger.info("Deleted old/duplicate message: %s", ts)
+        except Exception as e:
+            logger.warning("Failed to delete message %s: %s", ts, e)
+
+    def _load_local_pipeline_data(self) -> dict | None:
+        """Fold the local state log into a single state dict.
+
+        The first line is a full snapshot; each later line carries the
+        top-level fields plus only the phases that changed.
+        """
+        try:
+            raw = _read_cache_file(self.state_file)
+        except OSError as e:
+            logger.warning("Ignoring unreadable local pipeline state %s: %s", self.state_file, e)
+            return None
+
+        if raw is None:
+            return None
+        lines = raw.splitlines()
+
+        data = None
+        for line in lines:
             try:
-                self._slack_request('chat.delete', {
-                    'channel': self.storage_channel_id,
-                    'ts': ts
-                })
-                logger.info(f"Deleted old/duplicate message: {ts}")
-            except Exception as e:
-                logger.warning(f"Failed to delete message {ts}: {e}")
+                entry = _json_loads(line)
+            except ValueError:
+                logger.warning("Skipping malformed line in local pipeline state %s", self.state_file)
+                continue
 
-        return pipeline_msg
+            phases = _phases_by_name(entry.pop('phases', {}))
+            if data is None:
+                data = entry
+                data['phases'] = phases
+            else:
+                data.update(entry)
+                data['phases'].update(phases)
+
+        return data
 
-    def _get_pipeline_data(self) -> Dict:
+    def _get_pipeline_data(self) -> dict:
+        """Load pipeline state, preferring the local state file while it is current.
+
+        With the storage mirror disabled the local file is the only copy.
+        Otherwise parallel jobs of the workflow may have saved newer state
+        to the storage channel, which then replaces the local state.
+        """
+        local = self._load_local_pipeline_data()
 
-        pipeline_msg = self._cleanup_and_find_pipeline()
+        if not self.mirror_storage:
+            pipeline_msg = None
+        elif local is not None:
+            pipeline_msg = self._newer_storage_pipeline(local)
+        else:
+            pipeline_msg = self._find_pipeline()
 
         if pipeline_msg:
             data = pipeline_msg['data'].copy()
             data['_storage_ts'] = pipeline_msg['ts']
-            logger.info(f"Found existing pipeline data with storage_ts: {pipeline_msg['ts']}")
+            data['phases'] = _phases_by_name(data.get('phases', {}))
+            logger.info("Found existing pipeline data with storage_ts: %s", pipeline_msg['ts'])
+            if local is not None:
+                if os.path.exists(self.pending_file):
+                    # Deferred updates are only in the local state; keep the phases they touched.
+                    for name, p in local['phases'].items():
+                        stored = data['phases'].get(name)
+                        if stored is None or p.get('last_updated', 0) > stored.get('last_updated', 0):
+                            data['phases'][name] = p
+                # Later steps append to the local log, so replace the stale one first.
+                self._write_local_state(self._serializable_state(data), None, None)
             return data
 
+        if local is not None:
+            logger.info("Loaded pipeline data from local state: %s", self.state_file)
+            return local
+
         logger.info("No existing pipeline data found, creating new")
+        return self._new_pipeline_data()
+
+    def _new_pipeline_data(self) -> dict:
+
         return {
             'workflow_id': self.workflow_id,
-            'phases': [],
+            'phases': {},
             'message_ts': None,
             'created_at': time.time(),
             '_storage_ts': None
         }
 
-    def _save_pipeline_data(self, data: Dict) -> None:
+    def _newer_storage_pipeline(self, local: dict) -> dict | None:
+        """Return this workflow's storage state if it is newer than the local state.
+
+        One short conversations.history call from the local state's storage
+        message usually settles it; the full search is the fallback. A
+        storage message the full search does not turn up has been deleted
+        or aged out, so the local state stops pointing at it.
+        """
+        try:
+            pipeline_msg = None
+            if local.get('_storage_ts'):
+                pipeline_msg = self._call_storage(self._find_pipeline_since, local['_storage_ts'])
+            if pipeline_msg is None:
+                pipeline_msg = self._find_pipeline()
+                found_ts = pipeline_msg['ts'] if pipeline_msg else None
+                if local.get('_storage_ts') != found_ts:
+                    logger.info("Local storage_ts %s not found in storage, using %s",
+                                local.get('_storage_ts'), found_ts)
+                    local['_storage_ts'] = found_ts
+        except Exception as e:
+            logger.warning("Could not check local pipeline state against storage: %s", e)
+            return None
+
+        if pipeline_msg and pipeline_msg['data'].get('timestamp', 0) > local.get('timestamp', 0):
+            return pipeline_msg
+        return None
+
+    def _save_pipeline_data(self, data: dict, changed_phase: str | None = None) -> Future | None:
+        """Persist pipeline state locally and, if enabled, to the storage channel.
+
+        The local state is written first, before returning; the storage
+        channel copy is saved in the background and the returned future
+        must be waited on. The storage channel always receives the full
+        state. Locally, only changed_phase is appended to the state log when
+        it is given; otherwise a full snapshot is written.
+        """
+        state = self._serializable_state(data)
+        state['timestamp'] = time.time()
+        serialized = _json_dumps(state) if self.mirror_storage else None
+
+        self._write_local_state(state, changed_phase, serialized)
+
+        if not self.mirror_storage:
+            return None
+        return self._executor.submit(self._mirror_pipeline_data, data, serialized)
+
+    def _mirror_pipeline_data(self, data: dict, serialized: bytes) -> None:
+
+        storage_ts = self._call_storage(self._save_storage_message, serialized, data.get('_storage_ts'))
+        if storage_ts != data.get('_storage_ts'):
+            data['_storage_ts'] = storage_ts
+            self._append_local_state({'_storage_ts': storage_ts})
+
+    def _write_local_state(self, state: dict, changed_phase: str | None,
+                           serialized: bytes | None) -> None:
+
+        try:
+            log_size = os.path.getsize(self.state_file)
+        except OSError:
+            log_size = None
+
+        if changed_phase is None or log_size is None or log_size > STATE_LOG_COMPACT_SIZE:
+            # Start (or compact) the log with a single full snapshot.
+            _atomic_write(self.state_file, (serialized or _json_dumps(state)) + b'\n')
+            return
+
+        entry = {k: v for k, v in state.items() if k != 'phases'}
+        entry['phases'] = {changed_phase: state['phases'][changed_phase]}
+        self._append_local_state(entry)
+
+    def _append_local_state(self, entry: dict) -> None:
+
+        # A single O_APPEND write: no buffered file object, and the line
+        # lands whole at the end of the log.
+        fd = os.open(self.state_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, _json_dumps(entry) + b'\n')
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _serializable_state(data: dict) -> dict:
+        """Return a copy of data without the in-memory '_steps_seen' sets."""
+        state = dict(data)
+        state['phases'] = {
+            name: {k: v for k, v in p.items() if k != '_steps_seen'}
+            for name, p in data.get('phases', {}).items()
+        }
+        return state
 
-        storage_ts = data.get('_storage_ts')
-        save_data = {k: v for k, v in data.items() if k != '_storage_ts'}
-        save_data['timestamp'] = time.time()
+    def _save_storage_message(self, serialized: bytes, storage_ts: str | None) -> str:
 
         payload = {
             'channel': self.storage_channel_id,
-            'text': json.dumps(save_data)
+            'text': serialized.decode('utf-8')
         }
 
         if storage_ts:
-            payload['ts'] = storage_ts
-            self._slack_request('chat.update', payload)
-            logger.info(f"Updated existing storage message: {storage_ts}")
-        else:
-            response = self._slack_request('chat.postMessage', payload)
-            new_ts = response['ts']
-            data['_storage_ts'] = new_ts
-            logger.info(f"Created new storage message: {new_ts}")
-
-    def _update_phase_data(self, data: Dict, phase: str, status: str, step: str,
+            try:
+                self._slack_request('chat.update', dict(payload, ts=storage_ts))
+                logger.info("Updated existing storage message: %s", storage_ts)
+                return storage_ts
+            except SlackAPIError as e:
+                if e.error not in STALE_MESSAGE_ERRORS:
+                    raise
+                logger.warning("Storage message %s can no longer be updated (%s), posting a new one",
+                               storage_ts, e.error)
+
+        response = self._slack_request('chat.postMessage', payload)
+        new_ts = response['ts']
+        logger.info("Created new storage message: %s", new_ts)
+        return new_ts
+
+    def _update_phase_data(self, data: dict, phase: str, status: str, step: str,
                            color_key: str, is_final: bool) -> None:
 
-        color = self.colors.get(color_key, self.colors["progress"])
-        phases = data.get('phases', [])
-
-        phase_found = False
-        for p in phases:
-            if p['name'] == phase:
-                phase_found = True
+        color = COLORS.get(color_key, DEFAULT_COLOR)
+        phases = data.get('phases', {})
+        p = phases.get(phase)
 
-                if p.get('color') != self.colors["failure"]:
-                    p['status'] = status
-                    p['color'] = color
-                    p['is_final'] = is_final
+        if p is not None:
+            if p.get('color') != FAILURE_COLOR:
+                p['status'] = status
+                p['color'] = color
+                p['is_final'] = is_final
 
-                if 'steps' not in p:
-                    p['steps'] = []
+            if 'steps' not in p:
+                p['steps'] = []
+            if '_steps_seen' not in p:
+                p['_steps_seen'] = set(p['steps'])
 
-                if step not in p['steps']:
-                    p['steps'].append(step)
+            if step not in p['_steps_seen']:
+                p['_steps_seen'].add(step)
+                p['steps'].append(step)
 
-                p['last_updated'] = time.time()
-                break
-
-        if not phase_found:
+            p['last_updated'] = time.time()
+        else:
             current_time = time.time()
-            phases.append({
+            # New phases start now, so inserting at the end keeps the dict ordered by started_at.
+            phases[phase] = {
                 'name': phase,
                 'status': status,
                 'color': color,
                 'is_final': is_final,
                 'steps': [step],
+                '_steps_seen': {step},
                 'started_at': current_time,
                 'last_updated': current_time
-            })
+            }
 
         data['phases'] = phases
 
-    def _build_message_attachments(self, data: Dict) -> List[Dict]:
+    def _build_message_body(self, data: dict, message_ts: str | None = None) -> bytes:
+        """Encode the chat.postMessage / chat.update body for the main message.
 
-        branch = os.environ.get('CIRCLE_BRANCH', 'unknown')
-        username = os.environ.get('CIRCLE_USERNAME', 'unknown')
-        build_url = os.environ.get('CIRCLE_BUILD_URL', '#')
-        repo_name = os.environ.get('CIRCLE_PROJECT_REPONAME', 'repo')
-        build_num = os.environ.get('CIRCLE_BUILD_NUM', '0')
+        The header attachment is encoded ahead of time, so the body is
+        spliced together from it and the encoded phase attachments rather
+        than serialising the whole payload dict.
+        """
+        phase_bytes = _json_dumps(self._render_phase_attachments(data.get('phases', {})))
+        body = b'{"channel":' + _json_dumps(self.channel) + b',"attachments":[' + self._header_bytes
+        if phase_bytes != b'[]':
+            body += b',' + phase_bytes[1:-1]
+        body += b']'
+        if message_ts:
+            body += b',"ts":' + _json_dumps(message_ts)
+        return body + b'}'
 
-        header = {
-            "color": "#2196F3",
-            "blocks": [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": (
-                            f"🚀 *{self.pipeline_title}*\n\n"
-                            f"*Branch:* `{branch}` | *User:* `{username}`\n"
-                            f"<{build_url}|View Pipeline>"
-                        )
-                    }
-                },
-                {
-                    "type": "context",
-                    "elements": [
-                        {
-                            "type": "mrkdwn",
-                            "text": f":gear: `{repo_name}` | :hash: Build #{build_num}"
-                        }
-                    ]
-                }
-            ]
-        }
+    def _render_phase_attachments(self, phases: dict[str, dict]) -> list[dict]:
 
-        phases = data.get('phases', [])
-        sorted_phases = sorted(phases, key=lambda x: x.get('started_at', 0))
+        if len(phases) == 1:
+            phase = next(iter(phases.values()))
+            if len(phase.get('steps', ())) == 1:
+                return self._build_first_step_attachments(phase)
 
         phase_attachments = []
-        for phase in reversed(sorted_phases):
+        for phase in reversed(list(phases.values())):
             steps_text = '\n'.join(f"• {step}" for step in phase.get('steps', []))
             attachment = {
                 "color": phase['color'],
@@ -310,46 +778,135 @@ class SlackNotifier:
             }
             phase_attachments.append(attachment)
 
-        return [header] + phase_attachments
+        return phase_attachments
+
+    def _build_first_step_attachments(self, phase: dict) -> list[dict]:
+        """Specialised _render_phase_attachments for a single phase with a single step.
+
+        This is the shape of every workflow's first update, so it skips the
+        generic per-phase loop and step join.
+        """
+        return [
+            {
+                "color": phase['color'],
+                "blocks": [
+                    {
+                        "type": "section",
+                        "text": {
+                            "type": "mrkdwn",
+                            "text": FIRST_STEP_TEXT % (phase['status'], phase['steps'][0])
+                        }
+                    }
+                ]
+            }
+        ]
+
+    @staticmethod
+    def _wait_for_save(save_future: Future | None) -> None:
+        """Wait for the storage channel save, re-raising its error if it failed.
+
+        A save still running after STORAGE_SAVE_TIMEOUT is reported but
+        still waited on, so a failed save always fails the step.
+        """
+        if save_future is None:
+            return
+        try:
+            save_future.result(timeout=STORAGE_SAVE_TIMEOUT)
+        except FutureTimeoutError:
+            logger.warning("State save still running after %ss, waiting for it", STORAGE_SAVE_TIMEOUT)
+            save_future.result()
+
+    def _publish(self, pipeline_data: dict, changed_phase: str | None = None) -> None:
+        """Save pipeline state and post or update the main message to match it."""
+        message_ts = pipeline_data.get('message_ts')
+
+        if message_ts:
+            # The local state is saved before the main message edit; the
+            # storage channel save runs concurrently with it.
+            save_future = self._save_pipeline_data(pipeline_data, changed_phase)
+            body = self._build_message_body(pipeline_data, message_ts)
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+            if digest == _read_cache_file(self.payload_hash_file):
+                logger.info("Main message already up to date, skipping update: %s", message_ts)
+            else:
+                self._slack_request("chat.update", body)
+                _atomic_write(self.payload_hash_file, digest)
+                logger.info("Updated main message: %s", message_ts)
+            self._wait_for_save(save_future)
+        else:
+            # Post first so the single save below already carries message_ts.
+            response = self._slack_request("chat.postMessage", self._build_message_body(pipeline_data))
+            message_ts = response['ts']
+            pipeline_data['message_ts'] = message_ts
+            save_future = self._save_pipeline_data(pipeline_data, changed_phase)
+            logger.info("Created main message: %s", message_ts)
+            self._wait_for_save(save_future)
+
+        try:
+            os.remove(self.pending_file)
+        except FileNotFoundError:
+            pass
 
     def update(self, phase: str, status: str, step: str,
                color: str = "progress", is_final: bool = False) -> None:
 
         try:
-            logger.info(f"Starting update for phase: {phase}, workflow: {self.workflow_id}")
+            logger.info("Starting update for phase: %s, workflow: %s", phase, self.workflow_id)
 
             pipeline_data = self._get_pipeline_data()
 
             self._update_phase_data(pipeline_data, phase, status, step, color, is_final)
 
-            self._save_pipeline_data(pipeline_data)
+            self._publish(pipeline_data, phase)
+
+        except Exception as e:
+            logger.error("Failed to update Slack notification: %s", e)
+            sys.exit(1)
 
-            attachments = self._build_message_attachments(pipeline_data)
+    def update_local(self, phase: str, status: str, step: str,
+                     color: str = "progress", is_final: bool = False) -> None:
+        """Record a phase update in the local state only, leaving Slack untouched.
 
-            payload = {
-                "channel": self.channel,
-                "attachments": attachments
-            }
+        The update is marked pending and reaches Slack on the next flush()
+        or update(), which reconcile it with the storage channel, so a run
+        of steps costs no Slack calls until then. Both the update and the
+        marker live only in this runner's CACHE_DIR: the flush must run in
+        the same job, and a job that ends without one drops its deferred
+        updates.
+        """
+        try:
+            logger.info("Deferring update for phase: %s, workflow: %s", phase, self.workflow_id)
 
-            message_ts = pipeline_data.get('message_ts')
+            pipeline_data = self._load_local_pipeline_data() or self._new_pipeline_data()
 
-            if message_ts:
-                payload["ts"] = message_ts
-                self._slack_request("chat.update", payload)
-                logger.info(f"Updated main message: {message_ts}")
-            else:
-                response = self._slack_request("chat.postMessage", payload)
-                message_ts = response['ts']
-                pipeline_data['message_ts'] = message_ts
-                self._save_pipeline_data(pipeline_data)
-                logger.info(f"Created main message: {message_ts}")
+            self._update_phase_data(pipeline_data, phase, status, step, color, is_final)
+
+            self._write_local_state(self._serializable_state(pipeline_data), phase, None)
+            _atomic_write(self.pending_file, b'')
+
+        except Exception as e:
+            logger.error("Failed to record deferred update: %s", e)
+            sys.exit(1)
+
+    def flush(self) -> None:
+        """Publish updates recorded by update_local() with one Slack message update."""
+        if not os.path.exists(self.pending_file):
+            logger.warning(
+                "No deferred updates to flush for workflow %s; updates deferred in another job are not visible here",
+                self.workflow_id
+            )
+            return
+
+        try:
+            logger.info("Flushing deferred updates for workflow: %s", self.workflow_id)
+            self._publish(self._get_pipeline_data())
 
         except Exception as e:
-            logger.error(f"Failed to update Slack notification: {e}")
+            logger.error("Failed to flush Slack notification: %s", e)
             sys.exit(1)
 
-    def upload_file(self, file_path: str, title: Optional[str] = None,
-                    initial_comment: Optional[str] = None) -> None:
+    def upload_file(self, file_path: str, title: str | None = None,
+                    initial_comment: str | None = None) -> None:
         """Upload a file to the deploy channel, threaded under the pipeline message.
 
         Uses Slack's files.upload_v2 flow (getUploadURLExternal →
@@ -369,16 +926,24 @@ class SlackNotifier:
 
         with open(file_path, 'rb') as fh:
             payload = fh.read()
-        upload_req = urllib.request.Request(upload_url, data=payload, method='POST')
-        with urllib.request.urlopen(upload_req, timeout=120) as resp:
+        upload_parts = urlsplit(upload_url)
+        upload_conn = http.client.HTTPSConnection(upload_parts.netloc, timeout=120)
+        try:
+            upload_path = upload_parts.path + (f"?{upload_parts.query}" if upload_parts.query else '')
+            upload_conn.request('POST', upload_path, body=payload)
+            resp = upload_conn.getresponse()
             resp.read()
-        logger.info(f"Uploaded {filename} ({length} bytes) to Slack upload endpoint")
+        finally:
+            upload_conn.close()
+        if resp.status != 200:
+            raise SlackAPIError(f"HTTP {resp.status} {resp.reason} from file upload endpoint")
+        logger.info("Uploaded %s (%d bytes) to Slack upload endpoint", filename, length)
 
         pipeline_data = self._get_pipeline_data()
         message_ts = pipeline_data.get('message_ts')
 
         complete_payload = {
-            'files': json.dumps([{'id': file_id, 'title': title or filename}]),
+            'files': _json_dumps([{'id': file_id, 'title': title or filename}]).decode('utf-8'),
             'channel_id': self.channel,
         }
         if message_ts:
@@ -389,21 +954,24 @@ class SlackNotifier:
         try:
             self._slack_request('files.completeUploadExternal', complete_payload)
             logger.info(
-                f"File {filename} attached "
-                f"{'in thread ' + message_ts if message_ts else 'at channel root'}"
+                "File %s attached %s", filename,
+                f"in thread {message_ts}" if message_ts else "at channel root"
             )
         except Exception as e:
-            logger.error(f"Failed to complete file upload: {e}")
+            logger.error("Failed to complete file upload: %s", e)
             sys.exit(1)
 
 
 def main():
+    # Only the CLI entry point needs argparse; importing SlackNotifier skips it.
+    import argparse
+
     parser = argparse.ArgumentParser(description='Update Slack deployment status')
     parser.add_argument('--phase', help='Deployment phase name')
     parser.add_argument('--status', help='Status message')
     parser.add_argument('--step', help='Step description')
     parser.add_argument('--color', default='progress',
-                        choices=['start', 'progress', 'success', 'failure', 'skipped'],
+                        choices=tuple(COLORS),
                         help='Status color')
     parser.add_argument('--final', action='store_true', help='Mark phase as final')
     parser.add_argument('--title', default='Infrastructure Deployment Pipeline',
@@ -414,12 +982,21 @@ def main():
                         help='Override title for the uploaded file (default: filename)')
     parser.add_argument('--upload-comment',
                         help='Initial comment posted alongside the uploaded file')
+    parser.add_argument('--defer', action='store_true',
+                        help='Record the update locally and publish it on the next --flush '
+                             '(which must run in the same job)')
+    parser.add_argument('--flush', action='store_true',
+                        help='Publish updates deferred earlier in this job with a single Slack message update')
+    parser.add_argument('--cleanup', action='store_true',
+                        help='Delete stale and duplicate state messages from the storage channel')
 
     args = parser.parse_args()
 
     token = os.environ.get('SLACK_ACCESS_TOKEN')
     channel = os.environ.get('SLACK_CHANNEL', 'C090S4FDHDL')
     storage_channel_name = os.environ.get('SLACK_STORAGE_CHANNEL')
+    storage_channel_id = os.environ.get('SLACK_STORAGE_CHANNEL_ID')
+    mirror_storage = os.environ.get('SLACK_STORAGE_MIRROR', 'true').lower() not in ('0', 'false', 'no')
     workflow_id = os.environ.get('CIRCLE_WORKFLOW_ID')
 
     if not token:
@@ -430,12 +1007,18 @@ def main():
         logger.error("CIRCLE_WORKFLOW_ID environment variable not set")
         sys.exit(1)
 
-    if not storage_channel_name:
-        logger.error("SLACK_STORAGE_CHANNEL environment variable not set")
+    if (mirror_storage or args.cleanup) and not storage_channel_name and not storage_channel_id:
+        logger.error("SLACK_STORAGE_CHANNEL or SLACK_STORAGE_CHANNEL_ID environment variable not set")
         sys.exit(1)
 
-    notifier = SlackNotifier(token, channel, workflow_id, storage_channel_name)
-    notifier.pipeline_title = args.title
+    notifier = SlackNotifier(token, channel, workflow_id, storage_channel_name,
+                             storage_channel_id=storage_channel_id,
+                             mirror_storage=mirror_storage,
+                             pipeline_title=args.title)
+
+    if args.cleanup:
+        notifier.cleanup_storage()
+        return
 
     if args.upload_file:
         notifier.upload_file(
@@ -445,10 +1028,15 @@ def main():
         )
         return
 
+    if args.flush:
+        notifier.flush()
+        return
+
     if not all([args.phase, args.status, args.step]):
-        parser.error("--phase, --status, and --step are required unless --upload-file is set")
+        parser.error("--phase, --status, and --step are required unless --upload-file, --flush or --cleanup is set")
 
-    notifier.update(
+    update = notifier.update_local if args.defer else notifier.update
+    update(
         phase=args.phase,
         status=args.status,
         step=args.step,